@@ -1,28 +1,72 @@
 import os
 import io
+import csv
 import json
+import functools
+from operator import itemgetter
+import pickle
+from pathlib import Path
 import re
+import unicodedata
+import numpy as np
 import pandas as pd
 import streamlit as st
 from datetime import datetime, date
-from typing import Optional, List
+from typing import Optional, List, Tuple
 import math
 from zoneinfo import ZoneInfo  # <<< para horário de Brasília
 
+# Bibliotecas do Google são opcionais: sem elas o app consulta, mas não envia
+try:
+    import gspread
+    from google.oauth2.service_account import Credentials
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    _GSPREAD_OK = True
+except Exception:
+    _GSPREAD_OK = False
+
+# Parser JSON em C (orjson) quando disponível; senão o json da stdlib
+try:
+    import orjson as _json
+except ImportError:
+    _json = json
+
+_SCOPES = (
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive",
+)
+
+# Novas tentativas da API do Sheets só para limite de cota (429), respeitando Retry-After,
+# e para falha de conexão: nesses casos a requisição foi recusada antes de ser aplicada.
+# values.append não é idempotente, então 5xx e erro de leitura não são repetidos.
+_SHEETS_RETRY = Retry(
+    total=3,
+    read=False,
+    backoff_factor=1.5,
+    status_forcelist=(429,),
+    allowed_methods=None,
+    raise_on_status=False,
+) if _GSPREAD_OK else None
+
 # =========================
 # Google Sheets connection
 # =========================
+@functools.lru_cache(maxsize=1)
+def _build_creds(client_email: str, json_blob: str):
+    """Credentials memorizadas por conta de serviço (evita refazer o parse da chave RSA)."""
+    return Credentials.from_service_account_info(_json.loads(json_blob), scopes=_SCOPES)
+
+@st.cache_resource(show_spinner=False)
 def get_gspread_client():
     """
     Tenta autenticar com gspread usando, nesta ordem:
     1) st.secrets["gcp_service_account"]
     2) arquivo local "service_account.json"
     3) variável de ambiente GOOGLE_APPLICATION_CREDENTIALS
+    O cliente autenticado fica em cache (st.cache_resource) entre reruns.
     """
-    try:
-        import gspread
-        from google.oauth2.service_account import Credentials
-    except Exception:
+    if not _GSPREAD_OK:
         st.error("Bibliotecas do Google não estão instaladas. Adicione 'gspread' e 'google-auth' ao requirements.txt.")
         return None
 
@@ -36,8 +80,7 @@ def get_gspread_client():
         sa_path = "service_account.json"
         if os.path.exists(sa_path):
             try:
-                with open(sa_path, "r", encoding="utf-8") as f:
-                    creds_info = json.load(f)
+                creds_info = _json.loads(Path(sa_path).read_bytes())
             except Exception as e:
                 st.warning(f"Não consegui ler service_account.json: {e}")
         # 3) variável de ambiente
@@ -45,8 +88,7 @@ def get_gspread_client():
             env_path = os.environ["GOOGLE_APPLICATION_CREDENTIALS"]
             if os.path.exists(env_path):
                 try:
-                    with open(env_path, "r", encoding="utf-8") as f:
-                        creds_info = json.load(f)
+                    creds_info = _json.loads(Path(env_path).read_bytes())
                 except Exception as e:
                     st.warning(f"Não consegui ler credenciais de {env_path}: {e}")
 
@@ -58,15 +100,10 @@ def get_gspread_client():
         )
         return None
 
-    scope = [
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive",
-    ]
-    from google.oauth2.service_account import Credentials
-    credentials = Credentials.from_service_account_info(creds_info, scopes=scope)
-
-    import gspread  # garante disponível aqui também
+    credentials = _build_creds(creds_info.get("client_email", ""), json.dumps(dict(creds_info), sort_keys=True))
     client = gspread.authorize(credentials)
+    # Mesma sessão HTTP (keep-alive) para todos os envios, com novas tentativas em limite de cota
+    client.http_client.session.mount("https://", HTTPAdapter(max_retries=_SHEETS_RETRY, pool_maxsize=4))
     return client
 
 
@@ -89,65 +126,110 @@ FORM_HEADER = [
     "novo_email",
     "setorial",
 ]
+# Valores do payload já na ordem do FORM_HEADER (uma chamada em C, sem dict.get por campo)
+_HEADER_GETTER = itemgetter(*FORM_HEADER)
+# Campo ausente no payload vai vazio para a planilha (em vez de KeyError no itemgetter)
+_HEADER_DEFAULTS = dict.fromkeys(FORM_HEADER, "")
+
+# Textos tratados como "sem valor" (consulta O(1), sem pd.isna por célula)
+_VAZIOS = frozenset({"", "nan", "NaN", "NAN", "None"})
+
+def is_missing(value) -> bool:
+    """None, NA/NaT do pandas ou NaN (único valor diferente de si mesmo)."""
+    return value is None or value is pd.NA or value is pd.NaT or (isinstance(value, float) and value != value)
 
 def clean_value(value):
     """Limpa valores para serem compatíveis com JSON/Sheets"""
-    if value is None or pd.isna(value) or str(value).strip() in ['', 'nan', 'NaN']:
+    if is_missing(value):
         return ""
-    elif isinstance(value, (int, float)):
+    if isinstance(value, float):
         # Remove .0 de números inteiros
-        if value == int(value):
-            return str(int(value))
-        else:
-            return str(value)
-    else:
-        return str(value).strip()
+        return str(int(value)) if value.is_integer() else str(value)
+    if isinstance(value, int):
+        return str(int(value))
+    s = str(value).strip()
+    return "" if s in _VAZIOS else s
+
+# Campos de telefone do payload: recebem também a remoção do ".0" herdado de floats
+_PHONE_FIELDS = frozenset({"celular_whatsapp_atual", "novo_celular_whatsapp"})
+
+def clean_field(campo: str, value) -> str:
+    """
+    clean_value aplicado a um campo do payload do formulário; nos telefones,
+    remove também o ".0" herdado de floats.
+    """
+    s = clean_value(value)
+    if campo in _PHONE_FIELDS:
+        if s.endswith(".0"):
+            s = s[:-2]
+        elif s.count(".") == 1 and s.replace(".", "").isdigit():
+            s = str(int(float(s)))
+    return s
+
+@st.cache_resource(show_spinner=False)
+def get_worksheet(spreadsheet_id: str, worksheet_name: str):
+    """
+    Abre a aba de destino uma única vez por processo (st.cache_resource):
+    - Abre por ID (spreadsheet_id).
+    - Usa/Cria a aba worksheet_name.
+    Retorna None se não houver cliente autenticado.
+    """
+    client = get_gspread_client()
+    if client is None:
+        return None
+
+    sh = client.open_by_key(spreadsheet_id)
+
+    # Tenta abrir a aba; se não existir, cria
+    try:
+        return sh.worksheet(worksheet_name)
+    except gspread.WorksheetNotFound:
+        return sh.add_worksheet(title=worksheet_name, rows=1000, cols=max(len(FORM_HEADER), 10))
+
+@st.cache_resource(show_spinner=False)
+def header_state(_ws, spreadsheet_id: str, worksheet_name: str) -> dict:
+    """
+    Estado do cabeçalho da aba, compartilhado no processo (st.cache_resource).
+    Lê só a linha 1 (row_values) na primeira chamada; depois do primeiro envio
+    fica marcado como presente e nenhuma leitura extra é feita.
+    """
+    return {"ok": bool(_ws.row_values(1))}
 
 def salvar_em_planilha(dados_formulario: dict) -> bool:
     """
     Salva os dados do formulário em uma planilha do Google Sheets:
-    - Abre por ID (SPREADSHEET_ID).
-    - Usa/Cria a aba WORKSHEET_NAME.
-    - Garante cabeçalho FORM_HEADER se estiver vazia.
-    - Anexa a linha na ordem do FORM_HEADER.
+    - Usa a aba em cache de get_worksheet(SPREADSHEET_ID, WORKSHEET_NAME).
+    - Anexa a linha na ordem do FORM_HEADER, junto com o cabeçalho
+      FORM_HEADER se a aba estiver vazia, numa única chamada (append_rows).
     """
     try:
-        client = get_gspread_client()
-        if client is None:
+        ws = get_worksheet(SPREADSHEET_ID, WORKSHEET_NAME)
+        if ws is None:
+            # Não guarda a falha de autenticação no cache: tenta de novo no próximo envio
+            get_worksheet.clear()
+            get_gspread_client.clear()
             return False
 
-        import gspread
-        sh = client.open_by_key(SPREADSHEET_ID)
+        estado_cabecalho = header_state(ws, SPREADSHEET_ID, WORKSHEET_NAME)
 
-        # Tenta abrir a aba; se não existir, cria
-        try:
-            ws = sh.worksheet(WORKSHEET_NAME)
-        except gspread.WorksheetNotFound:
-            ws = sh.add_worksheet(title=WORKSHEET_NAME, rows=1000, cols=max(len(FORM_HEADER), 10))
-
-        existing = ws.get_all_values()
-        if not existing:
-            ws.append_row(FORM_HEADER, value_input_option="USER_ENTERED")
-
-        # Limpa todos os valores antes de enviar
-        cleaned_payload = {key: clean_value(value) for key, value in dados_formulario.items()}
-
-        # Remove .0 do final do telefone atual e novo
-        for campo in ['celular_whatsapp_atual', 'novo_celular_whatsapp']:
-            if campo in cleaned_payload:
-                valor = str(cleaned_payload[campo])
-                if valor.endswith('.0'):
-                    cleaned_payload[campo] = valor[:-2]
-                elif '.' in valor and valor.replace('.', '').isdigit():
-                    try:
-                        cleaned_payload[campo] = str(int(float(valor)))
-                    except:
-                        pass
-
-        row = [cleaned_payload.get(k, "") for k in FORM_HEADER]
-        ws.append_row(row, value_input_option="USER_ENTERED")
+        # Limpa os valores na ordem do FORM_HEADER, numa única passada
+        row = [clean_field(k, v) for k, v in zip(FORM_HEADER, _HEADER_GETTER({**_HEADER_DEFAULTS, **dados_formulario}))]
+        # Cabeçalho (se faltar) + linha vão juntos no endpoint values.append (uma chamada HTTP)
+        linhas = [row] if estado_cabecalho["ok"] else [FORM_HEADER, row]
+        ws.append_rows(linhas, value_input_option="USER_ENTERED", insert_data_option="INSERT_ROWS")
+        estado_cabecalho["ok"] = True
         return True
 
+    except gspread.exceptions.APIError as e:
+        # Só aba removida/renomeada (404, ou 400 com intervalo que não existe mais)
+        # descarta a aba e o cabeçalho em cache: o próximo envio reabre (e recria, se
+        # preciso). Cota (429), permissão (403) e 5xx mantêm o cache, sem chamadas extras.
+        if getattr(getattr(e, "response", None), "status_code", None) in (400, 404):
+            get_worksheet.clear()
+            header_state.clear()
+        st.error(f"Erro ao salvar na planilha: {e}")
+        return False
+
     except Exception as e:
         st.error(f"Erro ao salvar na planilha: {e}")
         return False
@@ -284,20 +366,201 @@ st.title("📝 Atualização de Dados")
 st.caption("Primeiro, selecione o município. Depois, consulte pelo aniversário ou busque pelo nome.")
 
 # ============ Entrada de dados base ============
-@st.cache_data(show_spinner=False)
-def load_csv(path_or_buffer) -> pd.DataFrame:
-    # Tenta detectar separador automaticamente
-    df = pd.read_csv(path_or_buffer, sep=None, engine="python")
-    # Normaliza nomes de colunas (sem acentos/caixa e troca espaços por sublinhado)
-    def norm(s: str) -> str:
-        import unicodedata, re as _re
-        s2 = ''.join(c for c in unicodedata.normalize('NFKD', s) if not unicodedata.combining(c))
-        s2 = s2.lower()
-        s2 = _re.sub(r'\s+', '_', s2.strip())
-        return s2
+# Padrões/tabelas compilados uma vez no import do módulo
+_WS_RE = re.compile(r"\s+")
+_NON_DIGIT = re.compile(r"\D+")
+# Remoção de acentos via str.translate (Latin-1 + Latin Extended-A: á, ç, õ, ...)
+_ACCENT_TABLE = {
+    cp: ''.join(c for c in unicodedata.normalize('NFKD', chr(cp)) if not unicodedata.combining(c))
+    for cp in range(0xC0, 0x180)
+}
+
+def fold_text(s: str) -> str:
+    """Remove acentos e passa para minúsculas ("João" -> "joao")."""
+    if not s.isascii():
+        s = s.translate(_ACCENT_TABLE)
+        if not s.isascii():
+            # Caracteres fora da tabela: cai no NFKD completo
+            s = ''.join(c for c in unicodedata.normalize('NFKD', s) if not unicodedata.combining(c))
+    return s.lower()
+
+@functools.lru_cache(maxsize=256)
+def norm(s: str) -> str:
+    """Normaliza nome de coluna (sem acentos/caixa, espaços viram sublinhado); memorizado por nome."""
+    return _WS_RE.sub('_', fold_text(s).strip())
+
+# ======== Colunas esperadas + utilitários ========
+CANDS_DN = ["data_de_nascimento","data_nascimento","data_nasc","nascimento","dt_nasc","dt_nascimento"]
+CANDS_NOME = ["nome_do_filiado","nome","nome_completo"]
+CANDS_EMAIL = ["e-mail","email","e_mail"]
+CANDS_WHATS = ["celular_whatsapp","celular","telefone","telefone_whatsapp","whatsapp"]
+# possíveis nomes para MUNICÍPIO (normalizados)
+CANDS_MUN = ["municipio", "municipios", "município", "municípios"]  # acentos somem na normalização
+
+def first_col(df, options: List[str]) -> Optional[str]:
+    # Conjunto de colunas normalizadas guardado por load_csv (df.attrs["norm_cols"])
+    col_set = df.attrs.get("norm_cols") or frozenset(df.columns)
+    return next((c for c in options if c in col_set), None)
+
+# Normaliza datas da coluna DN para datetime64 (vetorizado, sem loop por linha)
+DN_FORMATS = ("%d/%m/%Y", "%Y-%m-%d", "%d-%m-%Y", "%d/%m/%y")
+
+def parse_dn_series(serie: pd.Series) -> pd.Series:
+    """
+    Converte a coluna de nascimento para datetime64:
+    - tenta cada formato comum na coluna inteira, só nas linhas que ainda faltam;
+    - o que sobrar vai para o parser "mixed" (dayfirst) do pandas;
+    - valores inválidos viram NaT.
+    """
+    s = serie.astype("string").str.strip()
+    dn = pd.to_datetime(s, format=DN_FORMATS[0], errors="coerce")
+    for fmt in DN_FORMATS[1:]:
+        faltando = dn.isna() & s.notna()
+        if not faltando.any():
+            break
+        dn.loc[faltando] = pd.to_datetime(s[faltando], format=fmt, errors="coerce")
+    faltando = dn.isna() & s.notna()
+    if faltando.any():
+        dn.loc[faltando] = pd.to_datetime(s[faltando], format="mixed", dayfirst=True, errors="coerce")
+    return dn
+
+def peek_csv(path_or_buffer, size: int = 8192) -> str:
+    """Lê os primeiros bytes do CSV (caminho ou buffer) sem consumir o buffer."""
+    if isinstance(path_or_buffer, (str, os.PathLike)):
+        with open(path_or_buffer, "rb") as f:
+            head = f.read(size)
+    else:
+        pos = path_or_buffer.tell()
+        head = path_or_buffer.read(size)
+        path_or_buffer.seek(pos)
+    return head.decode("utf-8-sig", "ignore")
+
+def sniff_sep(head: str, default: str = ",") -> str:
+    """Detecta o separador a partir do início do arquivo (csv.Sniffer)."""
+    try:
+        return csv.Sniffer().sniff(head, delimiters=",;\t|").delimiter
+    except csv.Error:
+        return default
+
+def parse_csv(path_or_buffer) -> pd.DataFrame:
+    """Lê o CSV e normaliza colunas, datas de nascimento e tipos."""
+    # Separador detectado uma vez; a leitura fica com o parser C++ do pyarrow
+    head = peek_csv(path_or_buffer)
+    sep = sniff_sep(head)
+    # Lê só as colunas que o app usa (cabeçalho casado com os nomes candidatos)
+    header = next(csv.reader(io.StringIO(head), delimiter=sep), [])
+    wanted = set(CANDS_DN + CANDS_NOME + CANDS_EMAIL + CANDS_WHATS + CANDS_MUN)
+    usecols = [c for c in header if norm(c) in wanted] or None
+    df = pd.read_csv(path_or_buffer, sep=sep, engine="pyarrow", dtype_backend="pyarrow", usecols=usecols)
     df.columns = [norm(c) for c in df.columns]
+
+    # Datas de nascimento já convertidas (e guardadas no Parquet)
+    col = first_col(df, CANDS_DN)
+    if col:
+        df["_dn_date"] = parse_dn_series(df[col])
+
+    # Nome sem acentos e em minúsculas, calculado uma vez para a busca por nome
+    col = first_col(df, CANDS_NOME)
+    if col:
+        df["_nome_search"] = df[col].astype("string").fillna("").map(fold_text).astype("string")
+
+    # Telefone já no formato de exibição "(DD) 9XXXX-XXXX", calculado para a coluna inteira
+    col = first_col(df, CANDS_WHATS)
+    if col:
+        bruto = df[col].astype("string").str.strip()
+        bruto = bruto.mask(bruto.isin(["", "nan", "NaN"]))
+        dig = bruto.str.removesuffix(".0").str.replace(_NON_DIGIT, "", regex=True)
+        ddd, resto = dig.str[:2], dig.str[2:]
+        n = resto.str.len()
+        resto = resto.mask(n == 8, resto.str[:4] + "-" + resto.str[4:])
+        resto = resto.mask(n == 9, resto.str[:5] + "-" + resto.str[5:])
+        # Sem DDD (menos de 3 dígitos) fica só com os dígitos
+        df["_whats_fmt"] = ("(" + ddd + ") " + resto).where(dig.str.len() >= 3, dig)
+
+    # Colunas de texto com poucos valores distintos (município, filiação...) viram category
+    for c in df.select_dtypes(include=["string", "object"]).columns:
+        if df[c].nunique(dropna=True) < 0.5 * len(df):
+            df[c] = df[c].astype("category")
     return df
 
+# Versão dos arquivos de cache em disco: suba ao mudar as colunas gravadas no Parquet
+BASE_CACHE_VERSION = 6
+
+def remove_stale_sidecars(csv_path: str) -> None:
+    """
+    Apaga os caches em disco de versões anteriores, só pelos nomes exatos que
+    load_csv já gravou ("<csv>.vN.parquet" e o índice "<csv>.vN.parquet.idx.pkl").
+    """
+    for versao in range(1, BASE_CACHE_VERSION):
+        antigo = f"{csv_path}.v{versao}.parquet"
+        for caminho in (antigo, f"{antigo}.idx.pkl"):
+            try:
+                os.remove(caminho)
+            except OSError:
+                pass  # Não existe ou sem permissão: segue sem apagar
+
+@st.cache_data(show_spinner=False)
+def load_csv(path_or_buffer, mtime: Optional[float] = None) -> pd.DataFrame:
+    """
+    Carrega a base uma vez (st.cache_data).
+    mtime entra só na chave do cache: trocar o arquivo invalida a entrada.
+    """
+    df = None
+
+    # Cache em Parquet ao lado do CSV, só para arquivo local: evita reparse e datas no cold start
+    parquet_path = None
+    if isinstance(path_or_buffer, (str, os.PathLike)):
+        parquet_path = f"{path_or_buffer}.v{BASE_CACHE_VERSION}.parquet"
+        csv_mtime = os.path.getmtime(path_or_buffer)
+        if os.path.exists(parquet_path) and os.path.getmtime(parquet_path) >= csv_mtime:
+            try:
+                df = pd.read_parquet(parquet_path)
+            except Exception:
+                df = None  # Parquet inválido: refaz a partir do CSV
+
+    if df is None:
+        df = parse_csv(path_or_buffer)
+        if parquet_path:
+            try:
+                df.to_parquet(parquet_path, compression="zstd")
+                remove_stale_sidecars(path_or_buffer)
+            except Exception:
+                pass  # Sem permissão de escrita: segue só com o cache em memória
+
+    # Fica fora do Parquet (frozenset não é serializável nos metadados)
+    df.attrs["norm_cols"] = frozenset(df.columns)
+    return df
+
+@st.cache_resource(show_spinner=False)
+def get_dn_index(_df: pd.DataFrame, base_key) -> dict:
+    """
+    Índice data de nascimento -> posições (df.iloc) das linhas, para a consulta
+    por data ser um lookup O(1). Fica em st.cache_resource: é só leitura e não é
+    desserializado a cada rerun. Para arquivo local também vai para disco
+    (pickle ao lado do Parquet) e o cold start só relê o índice.
+    """
+    idx_path = None
+    if isinstance(base_key, tuple):
+        csv_path, csv_mtime = base_key
+        idx_path = f"{csv_path}.v{BASE_CACHE_VERSION}.parquet.idx.pkl"
+        try:
+            if os.path.getmtime(idx_path) >= csv_mtime:
+                with open(idx_path, "rb") as f:
+                    return pickle.load(f)
+        except Exception:
+            pass  # Sem índice em disco (ou inválido): monta de novo
+
+    dn_index = {}
+    if "_dn_date" in _df.columns:
+        dn_index = _df["_dn_date"].groupby(_df["_dn_date"]).indices
+    if idx_path:
+        try:
+            with open(idx_path, "wb") as f:
+                pickle.dump(dn_index, f, protocol=5)
+        except Exception:
+            pass
+    return dn_index
+
 # Aceita múltiplos nomes/variações do arquivo
 CSV_CANDIDATES = [
     "FILIADOSDADOS.CSV",
@@ -309,36 +572,72 @@ CSV_CANDIDATES = [
     "/mnt/data/FILADOSDADOS.CSV",
 ]
 
-csv_source = None
-for candidate in CSV_CANDIDATES:
-    if os.path.exists(candidate):
-        csv_source = candidate
-        break
+@st.cache_resource(show_spinner=False, ttl=30)
+def scan_csv() -> Optional[str]:
+    """
+    Procura o primeiro CSV_CANDIDATES existente, sem diferenciar maiúsculas/minúsculas.
+    Lê cada diretório uma vez (os.scandir) em vez de um stat() por candidato.
+    O ttl curto vale para o "não achou": um CSV colocado depois aparece em até 30 s,
+    sem varrer os diretórios a cada rerun enquanto isso.
+    """
+    listagens = {}
+    for candidate in CSV_CANDIDATES:
+        pasta, nome = os.path.split(candidate)
+        pasta = pasta or "."
+        if pasta not in listagens:
+            try:
+                listagens[pasta] = {e.name.lower(): e.name for e in os.scandir(pasta) if e.is_file()}
+            except OSError:
+                listagens[pasta] = {}
+        hit = listagens[pasta].get(nome.lower())
+        if hit:
+            return hit if pasta == "." else os.path.join(pasta, hit)
+    return None
+
+@st.cache_resource(show_spinner=False)
+def find_csv() -> str:
+    """
+    Caminho do CSV, guardado por processo (sem ttl) depois de achado.
+    Sem arquivo levanta FileNotFoundError, que não entra no cache: o negativo
+    fica só no ttl de scan_csv.
+    """
+    caminho = scan_csv()
+    if caminho is None:
+        raise FileNotFoundError("nenhum dos CSV_CANDIDATES foi encontrado")
+    return caminho
+
+def locate_csv() -> Tuple[Optional[str], Optional[float]]:
+    """(caminho, mtime) do CSV local, ou (None, None) se não houver."""
+    for _ in range(2):
+        try:
+            caminho = find_csv()
+        except FileNotFoundError:
+            return None, None
+        try:
+            return caminho, os.path.getmtime(caminho)
+        except FileNotFoundError:
+            # Caminho em cache foi removido/renomeado: descarta e procura de novo
+            find_csv.clear()
+            scan_csv.clear()
+    return None, None
+
+csv_source, csv_mtime = locate_csv()
 
 if not csv_source:
     up = st.file_uploader("Envie a planilha .csv (separadores automáticos).", type=["csv"])
     if up:
-        csv_source = io.BytesIO(up.read())
+        # UploadedFile já é um buffer em memória: usa direto, sem copiar os bytes
+        up.seek(0)
+        csv_source = up
 
 if not csv_source:
     st.stop()
 
 with st.spinner("Carregando a base..."):
-    df = load_csv(csv_source)
-
-# ======== Colunas esperadas + utilitários ========
-CANDS_DN = ["data_de_nascimento","data_nascimento","data_nasc","nascimento","dt_nasc","dt_nascimento"]
-CANDS_NOME = ["nome_do_filiado","nome","nome_completo"]
-CANDS_EMAIL = ["e-mail","email","e_mail"]
-CANDS_WHATS = ["celular_whatsapp","celular","telefone","telefone_whatsapp","whatsapp"]
-# possíveis nomes para MUNICÍPIO (normalizados)
-CANDS_MUN = ["municipio", "municipios", "município", "municípios"]  # acentos somem na normalização
-
-def first_col(df, options: List[str]) -> Optional[str]:
-    for c in options:
-        if c in df.columns:
-            return c
-    return None
+    df = load_csv(csv_source, csv_mtime)
+    # Identifica a base carregada para as derivações em cache (arquivo + mtime ou upload)
+    base_key = (csv_source, csv_mtime) if isinstance(csv_source, str) else csv_source.file_id
+    dn_index = get_dn_index(df, base_key)
 
 col_dn = first_col(df, CANDS_DN)
 col_nome = first_col(df, CANDS_NOME)
@@ -362,47 +661,57 @@ if not col_mun:
     st.error("A coluna de município não foi encontrada automaticamente e o filtro é obrigatório. Ajuste o cabeçalho do CSV (ex.: 'MUNICÍPIO').")
     st.stop()
 
-# Normaliza datas da coluna DN para tipo date
-def to_date_safe(v):
-    if pd.isna(v):
-        return None
-    # Tenta vários formatos comuns
-    for fmt in ("%d/%m/%Y", "%Y-%m-%d", "%d-%m-%Y", "%d/%m/%y"):
-        try:
-            return datetime.strptime(str(v).strip(), fmt).date()
-        except Exception:
-            continue
-    # Último recurso: pandas to_datetime
-    try:
-        return pd.to_datetime(v, dayfirst=True).date()
-    except Exception:
-        return None
+# Posições das colunas lidas do registro escolhido (acesso direto via df.iat)
+nome_pos = df.columns.get_loc(col_nome)
+email_pos = df.columns.get_loc(col_email)
+whats_pos = df.columns.get_loc(col_whats)
+whats_fmt_pos = df.columns.get_loc("_whats_fmt")
+dn_pos = df.columns.get_loc("_dn_date")
+
+# Datas no padrão dd/mm/aaaa montadas direto dos campos (sem strftime/locale)
+def format_date_br(d) -> str:
+    return f"{d.day:02d}/{d.month:02d}/{d.year:04d}"
+
+# Telefone digitado pelo usuário: mantém só os dígitos
+# Tabela para str.translate que apaga tudo que não é dígito no Latin-1
+_NON_DIGIT_TABLE = str.maketrans("", "", "".join(chr(i) for i in range(256) if not chr(i).isdecimal()))
 
-# Formatação do telefone: remove ".0" e não dígitos; coloca DDD entre parênteses
 def only_digits(s: str) -> str:
-    return re.sub(r"\D+", "", s or "")
-
-def format_phone_br(s: str) -> str:
-    digits = only_digits(str(s))
-    if digits.endswith('.0'):
-        digits = digits[:-2]
-    if len(digits) < 3:  # sem DDD não formatar
-        return digits
-    ddd = digits[:2]
-    resto = digits[2:]
-    if len(resto) == 8:
-        resto = f"{resto[:4]}-{resto[4:]}"
-    elif len(resto) == 9:
-        resto = f"{resto[:5]}-{resto[5:]}"
-    return f"({ddd}) {resto}"
-
-df["_dn_date"] = df[col_dn].apply(to_date_safe)
+    if not isinstance(s, str):
+        s = "" if s is None else str(s)
+    if s.isdecimal():
+        return s  # já só dígitos: nada a remover
+    d = s.translate(_NON_DIGIT_TABLE)
+    # Sobrou caractere fora do Latin-1: completa com a regex
+    return d if not d or d.isdecimal() else _NON_DIGIT.sub("", d)
+
+# Validação local dos campos de correção (antes de qualquer chamada à planilha)
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+_PHONE_RE = re.compile(r"^\(?\d{2}\)?\s?9?\d{4}-?\d{4}$")
 
 # ======== Filtro MUNICÍPIO (obrigatório) ========
 st.markdown('<div class="section-title">🏙️ Município</div>', unsafe_allow_html=True)
 
-muni_series = df[col_mun].fillna("").astype(str).str.strip()
-municipios = sorted(sorted(set([m for m in muni_series if m])), key=lambda x: x.casefold())
+@st.cache_resource(show_spinner=False)
+def get_muni_index(_serie: pd.Series, base_key) -> dict:
+    """
+    Índice município -> posições (df.iloc) das linhas, montado uma vez por base.
+    Fica em st.cache_resource: é só leitura e não é copiado a cada rerun.
+    """
+    chave = _serie.astype("string").str.strip()
+    return chave.groupby(chave, sort=False).indices
+
+@st.cache_data(show_spinner=False)
+def get_municipios(_muni_index: dict, base_key) -> List[str]:
+    """
+    Lista de municípios da base, ordenada sem diferenciar maiúsculas.
+    Calculada uma vez por base (base_key); o índice fica fora do hash do cache.
+    """
+    # Uma única ordenação; o desempate pelo próprio texto mantém a ordem estável
+    return sorted((m for m in _muni_index if m), key=lambda x: (x.casefold(), x))
+
+muni_index = get_muni_index(df[col_mun], base_key)
+municipios = get_municipios(muni_index, base_key)
 
 # selectbox obrigatório (sem "Todos")
 sel_muni = st.selectbox(
@@ -416,8 +725,72 @@ if not sel_muni:
     st.warning("Selecione um município para continuar.")
     st.stop()
 
-# filtra base pelo município escolhido
-df_base = df[df[col_mun].astype(str).str.strip() == sel_muni].copy()
+# linhas do município escolhido (consulta direta no índice, sem varrer df)
+muni_rows = muni_index[sel_muni]
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def get_nome_sufixos(_nomes: pd.Series, _rows, base_key, municipio: str):
+    """
+    Índice de busca por nome de um município, montado na primeira consulta a ele.
+    Os _nome_search do município são juntados num texto só (separados por NUL) e
+    o índice é um suffix array: os inícios de todos os sufixos desse texto, em
+    ordem. Todo trecho de um nome é início de algum sufixo, então a busca por
+    "contém" vira duas buscas binárias em vez de varrer o município.
+    Guarda só inteiros (memória linear no tamanho dos nomes); max_entries limita
+    quantos municípios ficam em memória.
+    Devolve (texto, sufixos, inicios, linhas): inicios[i] é onde começa o nome da
+    posição linhas[i] (df.iloc) dentro do texto.
+    """
+    valores = _nomes.to_numpy(dtype=object)
+    linhas = np.asarray([pos for pos in _rows if isinstance(valores[pos], str)], dtype=np.intp)
+    nomes = [valores[pos] for pos in linhas]
+    texto = "\0".join(nomes)
+    inicios = np.zeros(len(nomes), dtype=np.int64)
+    if nomes:
+        inicios[1:] = np.cumsum([len(nome) + 1 for nome in nomes[:-1]])
+
+    # Ordenação dos sufixos por duplicação de prefixo (ranks de 2^k caracteres)
+    rank = np.frombuffer(texto.encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+    n = len(rank)
+    sufixos = np.argsort(rank, kind="stable")
+    k = 1
+    while n and k < n:
+        # Par (rank, rank do trecho seguinte) numa chave só; 0 depois do fim
+        # (sufixo mais curto vem antes, como na comparação de str)
+        chave = (rank + 1) * (n + 2)
+        chave[:-k] += rank[k:] + 1
+        sufixos = np.argsort(chave, kind="stable")
+        chave = chave[sufixos]
+        novo = np.empty(n, dtype=np.int64)
+        novo[0] = 0
+        np.not_equal(chave[1:], chave[:-1], out=novo[1:])
+        rank = np.empty(n, dtype=np.int64)
+        rank[sufixos] = np.cumsum(novo)
+        if rank[sufixos[-1]] == n - 1:
+            break  # Todos os sufixos já têm rank distinto
+        k *= 2
+    return texto, sufixos.astype(np.int32), inicios, linhas
+
+def busca_sufixos(texto: str, sufixos: np.ndarray, busca: str) -> Tuple[int, int]:
+    """Faixa [lo, hi) de sufixos que começam com busca (bisect comparando só len(busca) caracteres)."""
+    m = len(busca)
+    lo, hi = 0, len(sufixos)
+    while lo < hi:
+        meio = (lo + hi) // 2
+        i = sufixos[meio]
+        if texto[i:i + m] < busca:
+            lo = meio + 1
+        else:
+            hi = meio
+    inicio, hi = lo, len(sufixos)
+    while lo < hi:
+        meio = (lo + hi) // 2
+        i = sufixos[meio]
+        if texto[i:i + m] <= busca:
+            lo = meio + 1
+        else:
+            hi = meio
+    return inicio, lo
 
 # ============ Formulário de consulta ============
 st.markdown('<div class="section-title">🔎 Consulta</div>', unsafe_allow_html=True)
@@ -429,7 +802,7 @@ tipo_consulta = st.radio(
     horizontal=True
 )
 
-selecionado = None
+pos_sel = None  # posição (linha) do filiado escolhido em df
 matches = pd.DataFrame()
 
 if tipo_consulta == "Consulta por data de nascimento":
@@ -443,8 +816,10 @@ if tipo_consulta == "Consulta por data de nascimento":
     )
     
     if dob is not None:
-        # Busca registros desta data na base filtrada
-        matches = df_base[df_base["_dn_date"] == dob].copy()
+        # Busca registros desta data pelo índice e restringe ao município escolhido
+        rows = dn_index.get(pd.Timestamp(dob))
+        if rows is not None:
+            matches = df.iloc[np.intersect1d(rows, muni_rows, assume_unique=True)]
 
 else:  # Consulta por nome
     nome_busca = st.text_input(
@@ -453,13 +828,18 @@ else:  # Consulta por nome
     )
     
     if nome_busca and len(nome_busca.strip()) >= 2:
-        nome_busca_clean = nome_busca.strip().lower()
-        mask = df_base[col_nome].str.lower().str.contains(nome_busca_clean, na=False)
-        matches = df_base[mask].copy()
-        
-        if len(matches) > 100:
-            st.warning(f"Foram encontrados {len(matches)} registros. Digite mais letras para refinar a busca.")
-            matches = matches.head(100)  # Limita a 100 resultados
+        nome_busca_clean = fold_text(nome_busca.strip())
+        # Sufixos que começam com a busca = nomes que contêm a busca: faixa [lo, hi)
+        texto, sufixos, inicios, linhas = get_nome_sufixos(df["_nome_search"], muni_rows, base_key, sel_muni)
+        lo, hi = busca_sufixos(texto, sufixos, nome_busca_clean)
+        # Início do sufixo -> nome que o contém; np.unique tira repetidos e mantém a ordem da base
+        encontrados = np.unique(linhas[np.searchsorted(inicios, sufixos[lo:hi], side="right") - 1])
+
+        if len(encontrados) > 100:
+            st.warning(f"Foram encontrados {len(encontrados)} registros. Digite mais letras para refinar a busca.")
+            encontrados = encontrados[:100]  # Limita a 100 resultados
+        # Só as linhas exibidas viram DataFrame
+        matches = df.iloc[encontrados]
     elif nome_busca and len(nome_busca.strip()) < 2:
         st.info("Digite pelo menos 2 caracteres para realizar a busca.")
 
@@ -473,44 +853,37 @@ if matches.empty:
 # Se houver mais de um, permite escolher pelo nome
 if len(matches) > 1:
     matches = matches.sort_values(by=col_nome)
-    opcoes = []
-    for _, row in matches.iterrows():
-        nome = row.get(col_nome, '(sem nome)')
-        data_nasc = row.get('_dn_date', '')
-        if data_nasc:
-            opcoes.append(f"{nome} ({data_nasc.strftime('%d/%m/%Y')})")
-        else:
-            opcoes.append(f"{nome} (data não informada)")
-    
-    escolha = st.selectbox("Selecione o filiado:", options=opcoes)
-    nome_escolhido = escolha.split(' (')[0]
-    selecionado = matches[matches[col_nome] == nome_escolhido].iloc[0]
+    # Rótulos montados das colunas em listas (no máximo 100 linhas), sem iterrows
+    opcoes = [
+        f"{nome} ({format_date_br(dn) if pd.notna(dn) else 'data não informada'})"
+        for nome, dn in zip(matches[col_nome].tolist(), matches["_dn_date"].tolist())
+    ]
+
+    # O widget devolve a posição em opcoes (mesma ordem de matches); nomes repetidos não se confundem
+    escolha = st.selectbox("Selecione o filiado:", options=range(len(opcoes)), format_func=opcoes.__getitem__)
+    pos_sel = df.index.get_loc(matches.index[escolha])
 else:
-    selecionado = matches.iloc[0]
+    pos_sel = df.index.get_loc(matches.index[0])
     st.success("✅ Encontrado 1 registro")
 
 # Função para formatar os valores e substituir NaN/vazios
 def formatar_valor(valor):
-    if valor is None or pd.isna(valor) or str(valor).strip() in ['', 'nan', 'NaN']:
+    if is_missing(valor):
         return "Sem informação (atualize)"
-    return str(valor).strip()
+    s = str(valor).strip()
+    return "Sem informação (atualize)" if s in _VAZIOS else s
 
 st.markdown("### 📄 Dados do cadastro")
 
-# Obtém e formata os valores
-nome_formatado = formatar_valor(selecionado.get(col_nome, ""))
-email_formatado = formatar_valor(selecionado.get(col_email, ""))
-telefone_raw = selecionado.get(col_whats, "")
-telefone_formatado = formatar_valor(telefone_raw)
-
-# Se não for "Sem informação", formata o telefone
-if telefone_formatado != "Sem informação (atualize)":
-    telefone_formatado = format_phone_br(telefone_formatado)
+# Obtém e formata os valores (telefone já vem formatado da carga da base)
+nome_formatado = formatar_valor(df.iat[pos_sel, nome_pos])
+email_formatado = formatar_valor(df.iat[pos_sel, email_pos])
+telefone_formatado = formatar_valor(df.iat[pos_sel, whats_fmt_pos])
 
 # Formata a data de nascimento para exibição
-data_nascimento = selecionado.get('_dn_date', '')
-if data_nascimento:
-    data_nascimento_formatada = data_nascimento.strftime('%d/%m/%Y')
+data_nascimento = df.iat[pos_sel, dn_pos]
+if pd.notna(data_nascimento):
+    data_nascimento_formatada = format_date_br(data_nascimento)
 else:
     data_nascimento_formatada = "Sem informação"
 
@@ -557,33 +930,40 @@ with colB:
 novo_fone = None
 novo_mail = None
 
-if opt_fone:
-    novo_fone = st.text_input("Novo Telefone/WhatsApp", placeholder="Ex. 88977776666")
+# Os checkboxes ficam fora do form (mostram/escondem os campos); o resto só
+# dispara rerun no envio, não a cada campo preenchido
+with st.form("envio_form"):
+    if opt_fone:
+        novo_fone = st.text_input("Novo Telefone/WhatsApp", placeholder="Ex. 88977776666")
 
-if opt_mail:
-    novo_mail = st.text_input("Novo E-mail", placeholder="exemplo@dominio.com")
+    if opt_mail:
+        novo_mail = st.text_input("Novo E-mail", placeholder="exemplo@dominio.com")
 
-# ============ Setorial ============
-st.markdown('<div class="section-title">🏷️ Setorial</div>', unsafe_allow_html=True)
-setorial = st.selectbox("Selecione um setorial", ["Selecione", "Cultura", "Agrário", "Outro"])
+    # ============ Setorial ============
+    st.markdown('<div class="section-title">🏷️ Setorial</div>', unsafe_allow_html=True)
+    setorial = st.selectbox("Selecione um setorial", ["Selecione", "Cultura", "Agrário", "Outro"])
 
-# ============ Envio para Google Sheets ============
-st.divider()
-st.markdown('<div class="section-title">📤 Enviar atualização</div>', unsafe_allow_html=True)
-st.caption("As respostas serão enviadas para o diretório municipal e atualizadas no sistema.")
+    # ============ Envio para Google Sheets ============
+    st.divider()
+    st.markdown('<div class="section-title">📤 Enviar atualização</div>', unsafe_allow_html=True)
+    st.caption("As respostas serão enviadas para o diretório municipal e atualizadas no sistema.")
 
-with st.form("envio_form"):
     submitted = st.form_submit_button("Enviar atualização")
     if submitted:
+        if opt_fone and novo_fone and not _PHONE_RE.match(novo_fone.strip()):
+            st.error("Telefone/WhatsApp inválido. Use DDD + número, ex.: (88) 97777-6666.")
+            st.stop()
+        if opt_mail and novo_mail and not _EMAIL_RE.match(novo_mail.strip()):
+            st.error("E-mail inválido. Verifique o endereço digitado, ex.: exemplo@dominio.com.")
+            st.stop()
+
         # Remove .0 do telefone atual e trata NaN
-        telefone_atual = clean_value(selecionado.get(col_whats, ""))
+        telefone_atual = clean_value(df.iat[pos_sel, whats_pos])
         if telefone_atual.endswith('.0'):
             telefone_atual = telefone_atual[:-2]
         
         # Se o usuário digitou novo telefone, salvar somente os dígitos e remover .0
-        def only_digits_local(x):
-            return re.sub(r"\D+", "", x or "")
-        novo_fone_digits = only_digits_local(novo_fone) if novo_fone else ""
+        novo_fone_digits = only_digits(novo_fone) if novo_fone else ""
         if novo_fone_digits.endswith('.0'):
             novo_fone_digits = novo_fone_digits[:-2]
 
@@ -591,14 +971,15 @@ with st.form("envio_form"):
         municipio_val = sel_muni
 
         # Timestamp no horário de Brasília
-        ts_br = datetime.now(ZoneInfo("America/Sao_Paulo")).strftime("%d/%m/%Y %H:%M:%S")
+        agora = datetime.now(ZoneInfo("America/Sao_Paulo"))
+        ts_br = f"{format_date_br(agora)} {agora.hour:02d}:{agora.minute:02d}:{agora.second:02d}"
 
         payload = {
             "timestamp": ts_br,
             "municipio": municipio_val,
-            "data_nascimento": data_nascimento_formatada if data_nascimento else "",
-            "nome_do_filiado": clean_value(selecionado.get(col_nome, "")),
-            "email_atual": clean_value(selecionado.get(col_email, "")),
+            "data_nascimento": data_nascimento_formatada if pd.notna(data_nascimento) else "",
+            "nome_do_filiado": clean_value(df.iat[pos_sel, nome_pos]),
+            "email_atual": clean_value(df.iat[pos_sel, email_pos]),
             "celular_whatsapp_atual": telefone_atual,
             "corrigir_telefone_whatsapp": "Sim" if opt_fone else "Não",
             "novo_celular_whatsapp": novo_fone_digits,